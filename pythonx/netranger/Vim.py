@@ -1,11 +1,17 @@
+import atexit
+import json
 import time
 
 import vim
 
-_hasnvim = int(vim.eval('has("nvim")'))
-gui_compaitable = int(
-    vim.eval('has("gui")')) or (int(vim.eval('has("termguicolors")'))
-                                and vim.options['termguicolors'])
+# Query all features at once to avoid one vim.eval round-trip per feature.
+_hasnvim, _hasgui, _hastgc, _tgc_on, _hastimers = [
+    int(x) for x in vim.eval('[has("nvim"), has("gui"), has("termguicolors"), '
+                             'exists("&termguicolors") && &termguicolors, '
+                             'has("timers")]')
+]
+gui_compaitable = _hasgui or (_hastgc and _tgc_on)
+_debug = vim.vars.get("_NETRDebug", False)
 
 # original api
 eval = vim.eval
@@ -24,25 +30,37 @@ if _hasnvim:
         return obj
 else:
 
+    _leaf_types = frozenset((bytes, str, int, float, bool))
+    _list_types = frozenset((list, tuple, vim.List))
+    _dict_types = frozenset((dict, vim.Dictionary))
+
     def walk(fn, obj, *args, **kwargs):
         """Recursively walk an object graph applying `fn`/`args` to objects."""
         objType = type(obj)
-        if objType in [list, tuple, vim.List]:
-            return list(walk(fn, o, *args) for o in obj)
-        elif objType in [dict, vim.Dictionary]:
-            return dict((walk(fn, k, *args), walk(fn, v, *args))
-                        for k, v in obj.items())
+        # Scalars are by far the most common case, check them first.
+        if objType in _leaf_types:
+            return fn(obj, *args, **kwargs)
+        elif objType in _list_types:
+            return [walk(fn, o, *args) for o in obj]
+        elif objType in _dict_types:
+            return {
+                walk(fn, k, *args): walk(fn, v, *args)
+                for k, v in obj.items()
+            }
         return fn(obj, *args, **kwargs)
 
 
-if vim.eval('has("timers")') == "1" and not vim.vars.get("_NETRDebug", False):
+if _hastimers and not _debug:
 
     def Timer(delay, fn, pyfn, *args):
-        if len(args):
-            vim.command(
-                f'call timer_start({delay}, function("{fn}", {list(args)}))')
-        else:
+        if not args:
             vim.command(f'call timer_start({delay}, "{fn}")')
+        else:
+            # A JSON array of numbers/strings is also a valid vim list literal,
+            # whereas Python's repr quotes strings with single quotes, which
+            # vim does not unescape.
+            vim.command(f'call timer_start({delay}, '
+                        f'function("{fn}", {json.dumps(args)}))')
 else:
 
     def Timer(delay, fn, pyfn, *args):
@@ -65,9 +83,17 @@ else:
             return f'[38;5;{c}m{msg}[0m'
 
 
+_log_fh = None
+
+
 def log(*msg):
-    with open('/tmp/netrlog', 'a') as f:
-        f.write(' '.join([str(m) for m in msg]) + '\n')
+    global _log_fh
+    if _log_fh is None:
+        # Line buffered so that the log is readable while vim is running.
+        _log_fh = open('/tmp/netrlog', 'a', buffering=1)
+        atexit.register(_log_fh.close)
+    _log_fh.write(' '.join(map(str, msg)))
+    _log_fh.write('\n')
 
 
 def decode_if_bytes(obj, mode=True):
@@ -168,17 +194,22 @@ def SetVar(name, value):
     vim.vars[name] = value
 
 
+# Translation table for embedding a message in a double-quoted vim string.
+_VIM_ESC = str.maketrans({'"': '\\"', '\\': '\\\\', '\n': ' '})
+
+
 def ErrorMsg(exception):
-    if hasattr(exception, 'output'):
-        msg = exception.output.decode('utf-8')
+    output = getattr(exception, 'output', None)
+    if output is not None:
+        msg = decode_if_bytes(output, 'replace')
     else:
         msg = str(exception)
     msg = msg.strip()
     if not msg:
         return
+    msg = msg.translate(_VIM_ESC)
     vim.command(
-        'unsilent echohl ErrorMsg | unsilent echo "{}" | echohl None '.format(
-            msg.replace('"', '\\"')))
+        f'unsilent echohl ErrorMsg | unsilent echo "{msg}" | echohl None ')
 
 
 def debug(*msg):
@@ -186,9 +217,9 @@ def debug(*msg):
 
 
 def WarningMsg(msg):
+    msg = msg.translate(_VIM_ESC)
     vim.command(
-        'unsilent echohl WarningMsg | unsilent echo "{}" | echohl None '.
-        format(msg.replace('"', '\\"')))
+        f'unsilent echohl WarningMsg | unsilent echo "{msg}" | echohl None ')
 
 
 def Echo(msg):
@@ -201,6 +232,9 @@ def UserInput(hint, default=''):
 
 
 class pbar(object):
+    # Minimal interval (in seconds) between two progress bar redraws.
+    redraw_interval = 0.033
+
     def __init__(self, objects, total=None, chunkSize=100):
         self.objects = iter(objects)
         if total is None:
@@ -210,7 +244,13 @@ class pbar(object):
         self.cur = 0
         self.chunkSize = chunkSize
         self.wid = vim.current.window.width
+        self._scale = self.wid / self.total if self.total else 0
+        self._last_update = 0.0
         self.st_save = vim.current.window.options['statusline']
+        # The status line is pointed at g:NETRProgress once, so that each
+        # update is a variable assignment instead of an option set.
+        vim.vars['NETRProgress'] = ''
+        vim.current.window.options['statusline'] = '%!g:NETRProgress'
 
     def __iter__(self):
         return self
@@ -223,8 +263,10 @@ class pbar(object):
         else:
             self.cur += 1
             if self.cur % self.chunkSize == 0:
-                vim.current.window.options[
-                    'statusline'] = "%#NETRhiProgressBar#{}%##".format(
-                        ' ' * int(self.cur * self.wid / self.total))
-                vim.command("redrawstatus!")
+                now = time.monotonic()
+                if now - self._last_update > self.redraw_interval:
+                    bar = ' ' * int(self.cur * self._scale)
+                    vim.vars['NETRProgress'] = f'%#NETRhiProgressBar#{bar}%##'
+                    vim.command("redrawstatus!")
+                    self._last_update = now
             return next(self.objects)
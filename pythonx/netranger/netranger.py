@@ -1117,6 +1117,8 @@ class Netranger(object):
         self._onuiquit_num_args = 0
         self._NetRangerBuf_init_winwidth = -1
         self._is_previewing = Vim.Var("NETRPreviewDefaultOn")
+        self._num_fs_op = 0
+        Vim.vars['_NETRNumFsOp'] = 0
 
         Rclone.init(Vim.Var('NETRemoteCacheDir'), Vim.Var('NETRemoteRoots'))
         Shell.mkdir(default.variables['NETRRootDir'])
@@ -1779,9 +1781,13 @@ class Netranger(object):
         6. To lock a buffer, we increase it's _num_fs_op by 1.
         7. To unlock a buffer, we decrease it's _num_fs_op by 1.
         8. A buffer is considered as locked if its _num_fs_op>0.
+        9. The number of pending operations is mirrored in g:_NETRNumFsOp so
+        that it can be read without going through the python host.
         """
         for buf in bufs:
             buf.inc_num_fs_op()
+        self._num_fs_op += 1
+        Vim.vars['_NETRNumFsOp'] = self._num_fs_op
 
     def dec_num_fs_op(self, bufs):
         """ Decrease number of filesystem operation by one for each buffer in bufs.
@@ -1799,6 +1805,10 @@ class Netranger(object):
                 if self._is_previewing:
                     cur_buf.preview_on()
 
+        # Only report the operation done after the buffer is refreshed.
+        self._num_fs_op -= 1
+        Vim.vars['_NETRNumFsOp'] = self._num_fs_op
+
     def _reset_pick_cut_copy(self):
         """
         Clean all picked_nodes/cut_nodes/copied_nodes. Separate from
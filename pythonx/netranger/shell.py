@@ -69,8 +69,7 @@ class Shell():
 
     @classmethod
     def mkdir(cls, name):
-        if not os.path.isdir(name):
-            os.makedirs(name)
+        os.makedirs(name, exist_ok=True)
 
     @classmethod
     def chmod(cls, fname, mode):
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import os
+import stat
 import string
 
 from netranger import Vim
@@ -46,7 +47,7 @@ class UI(object):
     def create_buf(self, content, mappings=None, name='default', map_cr=False):
         """ Create the UI buffer. """
         Vim.command(f'{self.position} new')
-        self.set_buf_common_option()
+        self.set_buf_common_option(modifiable=True)
         new_buf = Vim.current.buffer
         self.bufs[name] = new_buf
 
@@ -63,22 +64,17 @@ class UI(object):
                 ":let g:NETRRegister=[{}[getline('.')[0]]] <cr> :quit <cr>".
                 format(ui_internal_vim_dict_name))
 
-        new_buf.options['modifiable'] = True
         new_buf[:] = content
-        new_buf.options['modifiable'] = False
-        Vim.command('quit')
+        Vim.command('setlocal nomodifiable | quit')
 
     def set_buf_common_option(self, modifiable=False):
-        """ Set common option for a UI buffer. """
-        Vim.command('setlocal noswapfile')
-        Vim.command('setlocal foldmethod=manual')
-        Vim.command('setlocal foldcolumn=0')
-        Vim.command('setlocal nofoldenable')
-        Vim.command('setlocal nobuflisted')
-        Vim.command('setlocal nospell')
-        Vim.command('setlocal buftype=nofile')
-        Vim.command('setlocal bufhidden=hide')
-        Vim.command('setlocal nomodifiable')
+        """ Set common option for a UI buffer.
+        All options are set in a single setlocal to avoid an ex command
+        round-trip per option.
+        """
+        Vim.command('setlocal noswapfile foldmethod=manual foldcolumn=0 '
+                    'nofoldenable nobuflisted nospell buftype=nofile '
+                    f'bufhidden=hide {"" if modifiable else "no"}modifiable')
 
 
 class HelpUI(UI):
@@ -87,7 +83,7 @@ class HelpUI(UI):
         UI.__init__(self)
 
         self.create_buf(content=[
-            f'{fn:<25} {",".join(keys):<10} {desc}'
+            fn.ljust(25) + ' ' + ','.join(keys).ljust(10) + ' ' + desc
             for fn, (keys, desc) in keymap_doc.items()
         ])
 
@@ -110,20 +106,13 @@ class AskUI(UI):
         self.show()
         if len(content) > 24:
             Vim.WarningMsg('Ask only supports up to 24 commands.')
-            content = content[:24]
 
-        ind = 97
-        self.options = content[:]
-        self.options.append('vim')
+        self.options = content[:24] + ['vim']
         self.fullpath = fullpath
-        for i, c in enumerate(content):
-            content[i] = f'{chr(ind)}. {c}'
-            ind += 1
-        content.append(f'{chr(ind)}. vim')
 
         buf = self.bufs['default']
         buf.api.set_option('modifiable', True)
-        buf[:] = content
+        buf[:] = [f'{chr(97 + i)}. {c}' for i, c in enumerate(self.options)]
         buf.api.set_option('modifiable', False)
         self.netranger.pend_onuiquit(self._ask, 1)
 
@@ -143,29 +132,44 @@ class SortUI(UI):
         'd': lambda n: '',
         'e': lambda n: SortUI.ext_name(n.name),
         'm': lambda n: n.stat.st_ctime if n.stat is not None else -1,
-        's': lambda n: SortUI.size(n.fullpath),
+        's': lambda n: SortUI.size(n),
     }
 
     sort_fn_ch = 'd'
     reverse = False
 
     @classmethod
-    def size(self, path):
+    def size(self, node):
+        """ Return the size of a file or the number of entries of a
+        directory. The node's cached stat is used when available.
+
+        Note that the result is embedded in the string keys built by
+        NetRangerBuf.sort_nodes, hence it is zero-padded to a fixed width
+        so that lexicographic order matches numeric order. Nodes whose size
+        is unavailable (e.g. broken links) get -1, which also sorts first.
+        """
         try:
-            if os.path.isdir(path):
-                return str(len(os.listdir(path))).rjust(18)
+            st = node.stat
+            if st is None:
+                st = os.stat(node.fullpath)
+            if stat.S_ISDIR(st.st_mode):
+                with os.scandir(node.fullpath) as it:
+                    sz = sum(1 for _ in it)
             else:
-                return str(os.stat(path).st_size).rjust(18)
-        except PermissionError:
-            return -1
+                sz = st.st_size
+        except (PermissionError, FileNotFoundError):
+            sz = -1
+        return f'{sz:018d}'
 
     @classmethod
     def ext_name(self, path):
-        ind = path.rfind('.')
-        if ind < 0:
-            return ' '
-        else:
-            return path[ind + 1:]
+        """ Return the extension of path, or ' ' if there is none. A leading
+        dot (hidden file) does not start an extension.
+        """
+        head, sep, tail = path.rpartition('.')
+        if sep and head and not head.endswith('/'):
+            return tail
+        return ' '
 
     @classmethod
     def select_sort_fn(cls, ch):
@@ -182,9 +186,8 @@ class SortUI(UI):
         content.insert(
             0, 'Type keys for sorting option. Use captial letter '
             'for reverse (small to large) order')
-        mappings = [(k[0], k[0])
-                    for k in sort_opts] + [(k[0].upper(), k[0].upper())
-                                           for k in sort_opts]
+        mappings = [(k[0], k[0]) for k in sort_opts]
+        mappings.extend((k[0].upper(), k[0].upper()) for k in sort_opts)
         self.create_buf(content=content, mappings=mappings, map_cr=True)
 
 
@@ -207,25 +210,30 @@ class BookMarkUI(UI):
         self.netranger = netranger
         self.mark_dict = {}
         self.path_to_mark = None
+        self._set_buf_lines = []
+        self._mark_line_idx = {}
+        self._path_line_idx = {}
+        self._bookmark_file = Vim.Var('NETRBookmarkFile')
 
         # This is to avoid a bug that I can't solve.
         # If bookmark file is initially empty. The first time
         # 'm' (set) mapping is trigger, it won't quit the buffer
         # on user input..
-        if not os.path.isfile(Vim.Var('NETRBookmarkFile')):
-            with open(Vim.Var('NETRBookmarkFile'), 'w') as f:
+        if not os.path.isfile(self._bookmark_file):
+            with open(self._bookmark_file, 'w') as f:
                 f.write(f'~:{os.path.expanduser("~")}')
 
         self.load_bookmarks()
 
     def load_bookmarks(self):
         self.mark_dict = {}
-        if os.path.isfile(Vim.Var('NETRBookmarkFile')):
-            with open(Vim.Var('NETRBookmarkFile'), 'r') as f:
-                for line in f:
-                    kp = line.split(':')
-                    if (len(kp) == 2):
-                        self.mark_dict[kp[0].strip()] = kp[1].strip()
+        if os.path.isfile(self._bookmark_file):
+            with open(self._bookmark_file, 'r') as f:
+                lines = f.read().splitlines()
+            for line in lines:
+                k, sep, p = line.partition(':')
+                if sep:
+                    self.mark_dict[k.strip()] = p.strip()
 
     def set(self, path):
         """ Show the buffer for setting bookmark. """
@@ -234,10 +242,22 @@ class BookMarkUI(UI):
                 mappings=zip(self.valid_mark, self.valid_mark),
                 content=[f'{k}:{p}' for k, p in self.mark_dict.items()],
                 name='set')
+            self._index_set_buf()
         self.show('set')
         self.path_to_mark = path
         self.netranger.pend_onuiquit(self._set, 1)
 
+    def _index_set_buf(self):
+        """ Index lines of the BookMarkUI/set buffer by mark and by path so
+        that _set can find the line to update without scanning the buffer.
+        """
+        self._set_buf_lines = list(self.mark_dict.items())
+        self._mark_line_idx = {}
+        self._path_line_idx = {}
+        for i, (k, p) in enumerate(self._set_buf_lines):
+            self._mark_line_idx[k] = i
+            self._path_line_idx.setdefault(p, i)
+
     def _set(self, mark):
         """ The callback for the BookMarkUI/set. """
         if mark == '':
@@ -248,24 +268,35 @@ class BookMarkUI(UI):
         set_buf = self.bufs['set']
         set_buf.options['modifiable'] = True
 
-        if mark in self.mark_dict:
-            for i, line in enumerate(set_buf):
-                if len(line) > 0 and line[0] == mark:
-                    set_buf[i] = f'{mark}:{self.path_to_mark}'
-                    break
-        elif self.path_to_mark in self.mark_dict.values():
-            for i, line in enumerate(set_buf):
-                if len(line) > 0 and line[2:] == self.path_to_mark:
-                    set_buf[i] = f'{mark}:{self.path_to_mark}'
-                    break
+        path = self.path_to_mark
+        idx = self._mark_line_idx.get(mark)
+        if idx is None:
+            idx = self._path_line_idx.get(path)
+
+        if idx is None:
+            idx = len(self._set_buf_lines)
+            self._set_buf_lines.append((mark, path))
+            if idx == 0:
+                # A buffer created with no content still has one empty line.
+                set_buf[0] = f'{mark}:{path}'
+            else:
+                set_buf.append(f'{mark}:{path}')
         else:
-            set_buf.append(f'{mark}:{self.path_to_mark}')
+            old_mark, old_path = self._set_buf_lines[idx]
+            if self._mark_line_idx.get(old_mark) == idx:
+                del self._mark_line_idx[old_mark]
+            if self._path_line_idx.get(old_path) == idx:
+                del self._path_line_idx[old_path]
+            self._set_buf_lines[idx] = (mark, path)
+            set_buf[idx] = f'{mark}:{path}'
+        self._mark_line_idx[mark] = idx
+        self._path_line_idx.setdefault(path, idx)
+
         set_buf.options['modifiable'] = False
-        self.mark_dict[mark] = self.path_to_mark
+        self.mark_dict[mark] = path
         self.del_buf('go')
-        with open(Vim.Var('NETRBookmarkFile'), 'w') as f:
-            for k, p in self.mark_dict.items():
-                f.write(f'{k}:{p}\n')
+        with open(self._bookmark_file, 'w') as f:
+            f.write(''.join(f'{k}:{p}\n' for k, p in self.mark_dict.items()))
 
     def go(self):
         """ Show the buffer for going to bookmark. """
@@ -280,7 +311,7 @@ class BookMarkUI(UI):
 
     def edit(self):
         """ Show the buffer for editing the bookmark. """
-        Vim.command(f'belowright split {Vim.Var("NETRBookmarkFile")}')
+        Vim.command(f'belowright split {self._bookmark_file}')
         Vim.command('wincmd J')
         Vim.command('setlocal bufhidden=wipe')
         self.del_buf('set')
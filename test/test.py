@@ -1,12 +1,21 @@
 import argparse
 import os
 import re
+import shutil
+import stat
 import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from neovim import attach
 
+try:
+    from inotify_simple import INotify
+    from inotify_simple import flags as inotify_flags
+except ImportError:
+    INotify = None
+
 from netranger import default
 from netranger.colortbl import colorname2ind
 from netranger.config import (rclone_rcd_port, test_dir, test_local_dir,
@@ -14,25 +23,79 @@ from netranger.config import (rclone_rcd_port, test_dir, test_local_dir,
                               test_remote_name)
 from tshell import Shell
 
+_CONTENT_RE = re.compile(r'\[([34])8;5;([0-9]+)?m( *)([^ ]+)')
+_HL_RE = re.compile(r'\[38;5;([0-9]+)(;7)?m')
+_DIR_BG_RE = re.compile(r'\[48;5;[0-9]+mdir.*')
+_DIR2_FG_RE = re.compile(r'\[38;5;[0-9]+mdir2.*')
+
+test_template_dir = f'{test_dir}_template'
+
+_TABE_LOCAL = f'silent tabe {test_local_dir}'
+_VSPLIT_LOCAL = f'vsplit {test_local_dir}'
+# Keep the current tab (only + enew), wipe out all netranger buffers and
+# reopen test_local_dir, all in one request.
+_REOPEN_LOCAL = ("silent only | enew | for b in getbufinfo() | "
+                 "if getbufvar(b.bufnr, '&ft') ==# 'netranger' | "
+                 "exe 'bwipeout' b.bufnr | endif | endfor | "
+                 f"edit {test_local_dir}")
+
+
+# Color index string of each highlight key in default.color.
+_HI_STR = {
+    k: str(colorname2ind[v] if type(v) is str else v)
+    for k, v in default.color.items()
+}
+
 
 def color_str(hi_key):
-    hi = default.color[hi_key]
-    if type(hi) is str:
-        hi = colorname2ind[hi]
-    return str(hi)
+    return _HI_STR[hi_key]
 
 
-def assert_content(expected, level=None, ind=None, hi=None, hi_fg=False):
-    if ind is None:
-        line = nvim.current.line
+def get_buf_snapshot():
+    """
+    Fetch all lines of the current buffer and the cursor line number in one
+    request. The result can be passed as `snapshot` to
+    assert_content/assert_highlight to avoid requests per assert.
+    """
+    return nvim.eval('[getline(1, "$"), line(".")]')
+
+
+def assert_content(expected,
+                   level=None,
+                   ind=None,
+                   hi=None,
+                   hi_fg=False,
+                   snapshot=None):
+    if snapshot is None:
+        if ind is None:
+            line = nvim.current.line
+        else:
+            ind += 1
+            line = nvim.current.buffer[ind]
+        cLineNo = nvim.funcs.line('.') - 1
     else:
-        ind += 1
-        line = nvim.current.buffer[ind]
-
-    m = re.search(r'\[([34])8;5;([0-9]+)?m( *)([^ ]+)', line)
+        lines, cLineNo = snapshot
+        cLineNo -= 1
+        if ind is None:
+            line = lines[cLineNo]
+        else:
+            ind += 1
+            line = lines[ind]
+
+    if level is None and hi is None and line.startswith('\x1b['):
+        # Only the text and the background are checked. Split the line
+        # ('<esc>[{3,4}8;5;<color>m<indent><text>...') without the regex.
+        sgr, _, rest = line.partition('m')
+        bg = sgr[2]
+        text = rest.lstrip(' ').split(' ', 1)[0]
+        m = None
+    else:
+        m = _CONTENT_RE.search(line)
+        bg = m.group(1)
+        text = m.group(4)
 
-    assert m.group(4) == expected, 'expected:"{}", real: "{}"'.format(
-        expected, m.group(4))
+    assert text == expected, 'expected:"{}", real: "{}"'.format(
+        expected, text)
     if level is not None:
         assert m.group(
             3) == '  ' * level, "level mismatch: expected: {}, real:{}".format(
@@ -44,25 +107,25 @@ def assert_content(expected, level=None, ind=None, hi=None, hi_fg=False):
         'real_hi: "{}"'.format(expected_hi, m.group(2))
 
         if hi_fg:
-            assert m.group(1) == '4', 'Expect a foreground highlight'
+            assert bg == '4', 'Expect a foreground highlight'
 
-    cLineNo = nvim.eval("line('.')") - 1
     if ind is None or ind == cLineNo:
-        assert m.group(1) == '4', 'Background highlight mismatch. '
+        assert bg == '4', 'Background highlight mismatch. '
         'ind: {}, curLine: {}'.format(ind, cLineNo)
     else:
-        assert m.group(1) == '3', 'Background highlight mismatch. '
+        assert bg == '3', 'Background highlight mismatch. '
         'ind: {}, curLine: {}'.format(ind, cLineNo)
 
 
-def assert_highlight(expected, ind=None):
+def assert_highlight(expected, ind=None, snapshot=None):
     if ind is None:
         line = nvim.current.line
     else:
         ind += 1
-        line = nvim.current.buffer[ind]
+        line = nvim.current.buffer[
+            ind] if snapshot is None else snapshot[0][ind]
 
-    m = re.search(r'\[38;5;([0-9]+)(;7)?m', line)
+    m = _HL_RE.search(line)
     expected = color_str(expected)
     assert m.group(1) == expected, 'expected: "{}", real: "{}"'.format(
         expected, m.group(1))
@@ -79,6 +142,66 @@ def assert_num_content_line(numLine):
                               len(nvim.current.buffer) - 1)
 
 
+def ls_dirs_first(d):
+    """
+    In-process equivalent of 'ls --group-directories-first d' (hidden files
+    excluded). Return None if d does not exist.
+    """
+    try:
+        entries = [
+            e for e in os.scandir(d or '.') if not e.name.startswith('.')
+        ]
+    except FileNotFoundError:
+        return None
+    dirs = sorted(e.name for e in entries if e.is_dir())
+    files = sorted(e.name for e in entries if not e.is_dir())
+    return dirs + files
+
+
+def wait_ls_poll(d, expected, timeout):
+    """ Poll ls_dirs_first(d) with backoff until it equals `expected`. """
+    deadline = time.monotonic() + timeout
+    delay = 0.002
+    real = ls_dirs_first(d)
+    while real != expected and time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+        real = ls_dirs_first(d)
+    return real
+
+
+def wait_ls_inotify(d, expected, timeout):
+    """
+    Like wait_ls_poll, but re-list d only when inotify reports a change in d.
+    Fall back to wait_ls_poll if d itself is removed or replaced, since the
+    watch is dropped then.
+    """
+    deadline = time.monotonic() + timeout
+    watch_gone = (inotify_flags.IGNORED | inotify_flags.DELETE_SELF
+                  | inotify_flags.MOVE_SELF)
+    with INotify() as ino:
+        # Watch before listing so that no change is missed in between.
+        ino.add_watch(
+            d or '.', inotify_flags.CREATE | inotify_flags.DELETE
+            | inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM
+            | inotify_flags.DELETE_SELF | inotify_flags.MOVE_SELF)
+        real = ls_dirs_first(d)
+        while real != expected:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            events = ino.read(timeout=int(remaining * 1000) + 1)
+            if any(e.mask & watch_gone for e in events):
+                return wait_ls_poll(d, expected,
+                                    deadline - time.monotonic())
+            if events:
+                real = ls_dirs_first(d)
+    # Catch changes that land between the last read and the deadline.
+    if real != expected:
+        real = ls_dirs_first(d)
+    return real
+
+
 def assert_fs(d, expected, root=None):
     """
     Test whether 'expected' exists in directory cwd/d, where
@@ -87,21 +210,15 @@ def assert_fs(d, expected, root=None):
     """
 
     if root:
-        old_cwd = os.getcwd()
-        os.chdir(root)
+        d = os.path.join(root, d)
 
-    real = None
-    for i in range(10):
-        real = Shell.run('ls --group-directories-first ' + d).split()
-        if real == expected:
-            return
-        time.sleep(0.05)
+    if INotify is not None and os.path.isdir(d or '.'):
+        real = wait_ls_inotify(d, expected, 0.5)
+    else:
+        real = wait_ls_poll(d, expected, 0.5)
 
     assert real == expected, 'expected: {}, real: {}'.format(expected, real)
 
-    if root:
-        os.chdir(old_cwd)
-
 
 def assert_fs_cache(d, expected):
     assert_fs(d, expected, root=test_remote_cache_dir)
@@ -115,6 +232,35 @@ def assert_fs_remote(d, expected):
     assert_fs(d, expected, root=test_remote_dir)
 
 
+def build_test_template():
+    """
+    Build the directory tree every test starts from. do_test copies it to
+    test_local_dir and test_remote_dir. The copies must not be hard links
+    since tests modify the files (e.g. chmod, write).
+    """
+    shutil.rmtree(test_template_dir, ignore_errors=True)
+    Shell.mkdir(test_template_dir)
+    old_cwd = os.getcwd()
+    os.chdir(test_template_dir)
+    Shell.mkdir('dir/subdir')
+    Shell.mkdir('dir/subdir/subsubdir')
+    Shell.mkdir('dir/subdir2')
+    Shell.touch('dir/a')
+    Shell.touch('.a')
+    Shell.mkdir('dir2/')
+
+    # The following should be removed when rclone fix "not copying empty
+    # directories" bug.
+    Shell.touch('dir/subdir/subsubdir/placeholder')
+    Shell.touch('dir/subdir2/placeholder')
+    os.chdir(old_cwd)
+
+
+def prepare_test_dir(dirname):
+    shutil.copytree(test_template_dir, dirname, symlinks=True)
+    os.chdir(dirname)
+
+
 def do_test(fn=None, fn_remote=None):
     """
     Note on the mecahnism of testing rclone on localhost:
@@ -130,38 +276,29 @@ def do_test(fn=None, fn_remote=None):
        directory of the localhost.
     """
     old_cwd = os.getcwd()
-    Shell.run('rm -rf {}'.format(test_dir))
-
-    def prepare_test_dir(dirname):
-        Shell.mkdir(dirname)
-        os.chdir(dirname)
-        Shell.mkdir('dir/subdir')
-        Shell.mkdir('dir/subdir/subsubdir')
-        Shell.mkdir('dir/subdir2')
-        Shell.touch('dir/a')
-        Shell.touch('.a')
-        Shell.mkdir('dir2/')
-
-        # The following should be removed when rclone fix "not copying empty
-        # directories" bug.
-        Shell.touch('dir/subdir/subsubdir/placeholder')
-        Shell.touch('dir/subdir2/placeholder')
-        Shell.touch('dir/subdir2/placeholder')
+    shutil.rmtree(test_dir, ignore_errors=True)
 
     prepare_test_dir(test_local_dir)
     if fn is not None:
-        nvim.command('silent tabe {}'.format(test_local_dir))
+        nvim.command(_TABE_LOCAL)
         ensure_buf_no_expand()
         fn()
         print('== {} success =='.format(str(fn.__name__)))
 
     prepare_test_dir(test_remote_dir)
-    Shell.run('rm -rf {}/*'.format(test_remote_cache_dir))
     if fn_remote is not None:
+        # The remote cache directory is shared by all test processes, only
+        # touch it when testing remote functions.
+        if os.path.isdir(test_remote_cache_dir):
+            for entry in os.scandir(test_remote_cache_dir):
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
         nvim.command('NETRemoteList')
         found_remote = False
         for i, line in enumerate(nvim.current.buffer):
-            if re.findall('.+(netrtest)', line):
+            if line.find('netrtest') > 0:
                 nvim.command('call cursor({}, 1)'.format(i + 1))
                 found_remote = True
                 break
@@ -175,9 +312,36 @@ def do_test(fn=None, fn_remote=None):
         fn_remote()
         print('== {} success =='.format(str(fn_remote.__name__)))
 
+    close_test_tab()
+    os.chdir(old_cwd)
+
+
+def do_test_inplace(fn):
+    """
+    Same as do_test(fn), but reuse the tab left by a previous
+    do_test_inplace instead of opening a new tab and closing it afterwards.
+    Netranger buffers are still wiped out before each test so that cursor
+    positions and expansion states do not leak between tests. Call
+    close_test_tab after the last do_test_inplace.
+    """
+    old_cwd = os.getcwd()
+    shutil.rmtree(test_dir, ignore_errors=True)
+
+    prepare_test_dir(test_local_dir)
+    if nvim.eval('&ft') == 'netranger':
+        nvim.command(_REOPEN_LOCAL)
+    else:
+        nvim.command(_TABE_LOCAL)
+    ensure_buf_no_expand()
+    fn()
+    print('== {} success =='.format(str(fn.__name__)))
+    os.chdir(old_cwd)
+
+
+def close_test_tab():
+    """ Wipe out the netranger buffers of the current tab (hence close it). """
     while nvim.eval('&ft') == 'netranger':
         nvim.command('bwipeout')
-    os.chdir(old_cwd)
 
 
 def test_on_cursormoved():
@@ -205,9 +369,7 @@ def test_NETRParent():
 
 def test_NETRGoPrevSibling():
     # Test both NETRGoPrevSibling and NETRGoNextSibling
-    nvim.input('zA')
-    nvim.input('j')
-    nvim.input('}')
+    nvim.input('zAj}')
     assert_content('subdir2', hi='dir', hi_fg=True)
     nvim.input('}')
     assert_content('a', hi='file', hi_fg=True)
@@ -227,9 +389,10 @@ def test_on_bufenter_cursor_stay_the_same_pos():
 
 def test_on_bufenter_content_stay_the_same():
     nvim.input('zalh')
-    assert_content('dir', ind=0, hi='dir', hi_fg=True)
-    assert_content('subdir', level=1, ind=1, hi='dir')
-    assert_content('dir2', ind=4, hi='dir')
+    snapshot = get_buf_snapshot()
+    assert_content('dir', ind=0, hi='dir', hi_fg=True, snapshot=snapshot)
+    assert_content('subdir', level=1, ind=1, hi='dir', snapshot=snapshot)
+    assert_content('dir2', ind=4, hi='dir', snapshot=snapshot)
 
 
 def test_on_bufenter_fs_change():
@@ -239,9 +402,10 @@ def test_on_bufenter_fs_change():
     nvim.command('split new')
     nvim.command('quit')
     nvim.input('zA')
-    assert_content('dir', ind=0, hi='dir', hi_fg=True)
-    assert_content('b', ind=7, level=1, hi='file')
-    assert_content('dir3', ind=9, hi='dir')
+    snapshot = get_buf_snapshot()
+    assert_content('dir', ind=0, hi='dir', hi_fg=True, snapshot=snapshot)
+    assert_content('b', ind=7, level=1, hi='file', snapshot=snapshot)
+    assert_content('dir3', ind=9, hi='dir', snapshot=snapshot)
     assert_num_content_line(10)
 
     Shell.rm('dir/subdir2/placeholder')
@@ -251,11 +415,12 @@ def test_on_bufenter_fs_change():
 
 def test_NETRToggleExpand():
     nvim.input('za')
-    assert_content('dir', ind=0, hi='dir', hi_fg=True)
-    assert_content('subdir', level=1, ind=1, hi='dir')
-    assert_content('subdir2', ind=2, level=1, hi='dir')
-    assert_content('a', ind=3, level=1, hi='file')
-    assert_content('dir2', ind=4, hi='dir')
+    snapshot = get_buf_snapshot()
+    assert_content('dir', ind=0, hi='dir', hi_fg=True, snapshot=snapshot)
+    assert_content('subdir', level=1, ind=1, hi='dir', snapshot=snapshot)
+    assert_content('subdir2', ind=2, level=1, hi='dir', snapshot=snapshot)
+    assert_content('a', ind=3, level=1, hi='file', snapshot=snapshot)
+    assert_content('dir2', ind=4, hi='dir', snapshot=snapshot)
     nvim.input('za')
     assert_content('dir', ind=0, hi='dir', hi_fg=True)
     assert_content('dir2', ind=1, hi='dir')
@@ -263,14 +428,15 @@ def test_NETRToggleExpand():
 
 def test_NETRToggleExpandRec():
     nvim.input('zA')
-    assert_content('dir', ind=0, hi='dir', hi_fg=True)
-    assert_content('subdir', level=1, ind=1, hi='dir')
-    assert_content('subsubdir', level=2, ind=2, hi='dir')
-    assert_content('placeholder', level=3, ind=3, hi='file')
-    assert_content('subdir2', level=1, ind=4, hi='dir')
-    assert_content('placeholder', level=2, ind=5, hi='file')
-    assert_content('a', level=1, ind=6, hi='file')
-    assert_content('dir2', level=0, ind=7, hi='dir')
+    snapshot = get_buf_snapshot()
+    assert_content('dir', ind=0, hi='dir', hi_fg=True, snapshot=snapshot)
+    assert_content('subdir', level=1, ind=1, hi='dir', snapshot=snapshot)
+    assert_content('subsubdir', level=2, ind=2, hi='dir', snapshot=snapshot)
+    assert_content('placeholder', level=3, ind=3, hi='file', snapshot=snapshot)
+    assert_content('subdir2', level=1, ind=4, hi='dir', snapshot=snapshot)
+    assert_content('placeholder', level=2, ind=5, hi='file', snapshot=snapshot)
+    assert_content('a', level=1, ind=6, hi='file', snapshot=snapshot)
+    assert_content('dir2', level=0, ind=7, hi='dir', snapshot=snapshot)
     nvim.input('zA')
     assert_content('dir', ind=0, hi='dir', hi_fg=True)
     assert_content('dir2', ind=1, hi='dir')
@@ -284,30 +450,24 @@ def test_NETRVimCD():
 
 
 def test_NETREdit():
-    nvim.input('za')
-    nvim.input('iiz<Left><Down>')
-    nvim.input('y<Left><Down>')
-    nvim.input('x<Left><Down>')
-    nvim.input('w')
-    nvim.input('<esc>:w<cr>')
-    assert_content('dir2', ind=0, hi='dir')
-    assert_content('zdir', ind=1, hi='dir')
-    assert_content('xsubdir2', ind=2, level=1, hi='dir')
-    assert_content('ysubdir', ind=3, level=1, hi='dir')
-    assert_content('wa', ind=4, level=1, hi='file')
+    nvim.input('zaiiz<Left><Down>y<Left><Down>x<Left><Down>w<esc>:w<cr>')
+    snapshot = get_buf_snapshot()
+    assert_content('dir2', ind=0, hi='dir', snapshot=snapshot)
+    assert_content('zdir', ind=1, hi='dir', snapshot=snapshot)
+    assert_content('xsubdir2', ind=2, level=1, hi='dir', snapshot=snapshot)
+    assert_content('ysubdir', ind=3, level=1, hi='dir', snapshot=snapshot)
+    assert_content('wa', ind=4, level=1, hi='file', snapshot=snapshot)
 
     assert_fs('', ['dir2', 'zdir'])
     assert_fs('zdir', ['xsubdir2', 'ysubdir', 'wa'])
 
 
 def test_NETRNew():
-    nvim.input('odzd<CR>')
-    nvim.input('ofzf<CR>')
+    nvim.input('odzd<CR>ofzf<CR>')
     assert_content('zd', ind=2, hi='dir', level=0)
     assert_content('zf', ind=3, hi='file', level=0)
     assert_fs('', ['dir', 'dir2', 'zd', 'zf'])
-    nvim.input('<CR>odzd<CR>')
-    nvim.input('ofzf<CR>')
+    nvim.input('<CR>odzd<CR>ofzf<CR>')
     assert_fs('dir', ['subdir', 'subdir2', 'zd', 'a', 'zf'])
 
 
@@ -327,10 +487,11 @@ def test_NETRTogglePickVisual():
 
 def test_NETRCut():
     nvim.input('zajvjjvjd')
-    assert_content('dir', ind=0, hi='dir')
-    assert_content('subdir', ind=1, level=1, hi='cut')
-    assert_content('subdir2', ind=2, level=1, hi='dir')
-    assert_content('a', ind=3, level=1, hi='cut')
+    snapshot = get_buf_snapshot()
+    assert_content('dir', ind=0, hi='dir', snapshot=snapshot)
+    assert_content('subdir', ind=1, level=1, hi='cut', snapshot=snapshot)
+    assert_content('subdir2', ind=2, level=1, hi='dir', snapshot=snapshot)
+    assert_content('a', ind=3, level=1, hi='cut', snapshot=snapshot)
 
 
 def test_NETRCutSingle():
@@ -341,10 +502,11 @@ def test_NETRCutSingle():
 
 def test_NETRCopy():
     nvim.input('zajvjjvjy')
-    assert_content('dir', ind=0, hi='dir')
-    assert_content('subdir', ind=1, level=1, hi='copy')
-    assert_content('subdir2', ind=2, level=1, hi='dir')
-    assert_content('a', ind=3, level=1, hi='copy')
+    snapshot = get_buf_snapshot()
+    assert_content('dir', ind=0, hi='dir', snapshot=snapshot)
+    assert_content('subdir', ind=1, level=1, hi='copy', snapshot=snapshot)
+    assert_content('subdir2', ind=2, level=1, hi='dir', snapshot=snapshot)
+    assert_content('a', ind=3, level=1, hi='copy', snapshot=snapshot)
 
 
 def test_NETRCopySingle():
@@ -382,11 +544,18 @@ def test_NETRPaste_sided_by_side():
     assert_fs('dir2', ['subdir', 'a'])
 
 
-def wait_for_fs_free():
-    while nvim.command_output(
-            'python3 print(ranger.cur_buf._num_fs_op)') != '0':
-        pass
-    return
+def wait_for_fs_free(timeout=30.0):
+    """
+    Poll until netranger has no pending fs operation. The polling
+    interval starts small and backs off to 50 ms so that we don't flood
+    nvim with requests while it is doing the actual work.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.001
+    while nvim.vars['_NETRNumFsOp'] != 0:
+        assert time.monotonic() < deadline, 'fs operation timeout'
+        time.sleep(delay)
+        delay = min(delay * 1.5, 0.05)
 
 
 def lock_fs():
@@ -399,11 +568,10 @@ def unlock_fs():
 
 def ensure_buf_no_expand():
     nvim.input('2G')
-    m2 = re.search(r'\[48;5;[0-9]+mdir.*', nvim.eval('getline(2)'))
-    assert m2, "Assumes line2 is dir"
+    line2, line3 = nvim.current.buffer[1:3]
+    assert _DIR_BG_RE.search(line2), "Assumes line2 is dir"
 
-    m3 = re.search(r'\[38;5;[0-9]+mdir2.*', nvim.eval('getline(3)'))
-    if not m3:
+    if not _DIR2_FG_RE.search(line3):
         nvim.input('za')
 
 
@@ -411,9 +579,10 @@ def test_NETRDelete():
     nvim.input('zajvjjvD')
     wait_for_fs_free()
     assert_fs('dir', ['subdir2'])
-    assert_content('dir', ind=0, hi='dir')
-    assert_content('subdir2', ind=1, level=1, hi='dir')
-    assert_content('dir2', ind=2, hi='dir', hi_fg=True)
+    snapshot = get_buf_snapshot()
+    assert_content('dir', ind=0, hi='dir', snapshot=snapshot)
+    assert_content('subdir2', ind=1, level=1, hi='dir', snapshot=snapshot)
+    assert_content('dir2', ind=2, hi='dir', hi_fg=True, snapshot=snapshot)
 
 
 def test_NETRDeleteSingle():
@@ -437,15 +606,20 @@ def test_delete_single_fail_if_fs_lock():
     unlock_fs()
 
 
+def chmod_minus_w(path):
+    """ Equivalent to 'chmod u-w path'. """
+    Shell.chmod(path, os.stat(path).st_mode & ~stat.S_IWUSR)
+
+
 def test_NETRForceDelete():
-    Shell.run('chmod u-w dir/a')
+    chmod_minus_w('dir/a')
     nvim.input('zajjjvX')
     wait_for_fs_free()
     assert_content('dir2', ind=3, hi='dir', hi_fg=True)
 
 
 def test_NETRForceDeleteSingle():
-    Shell.run('chmod u-w dir/a')
+    chmod_minus_w('dir/a')
     nvim.input('zajjjXX')
     wait_for_fs_free()
     assert_content('dir2', ind=3, hi='dir', hi_fg=True)
@@ -467,19 +641,47 @@ def test_force_delete_single_fail_if_fs_lock():
 
 
 def test_bookmark():
-    Shell.run('rm -f {}'.format(nvim.vars['NETRBookmarkFile']))
+    bm = nvim.vars['NETRBookmarkFile']
+    try:
+        os.remove(bm)
+    except FileNotFoundError:
+        pass
 
-    nvim.input('mal')
-    nvim.input("'a")
+    nvim.input("mal'a")
     assert_content('dir')
 
     nvim.input('lemjrb')
     nvim.command('exit')
-    time.sleep(0.5)
+    # Wait for the edited mark ('a:' -> 'b:') to show up in the bookmark
+    # file instead of sleeping for a fixed amount of time. Unlike its
+    # mtime, the content changes even on filesystems with coarse
+    # timestamps.
+    deadline = time.monotonic() + 2
+    while time.monotonic() < deadline:
+        with open(bm) as f:
+            if any(line.startswith('b:') for line in f):
+                break
+        time.sleep(0.01)
     nvim.input("'b")
     assert_content('dir')
 
 
+def test_bookmark_set_twice_from_empty():
+    bm = nvim.vars['NETRBookmarkFile']
+    write_file(bm, '')
+    # Let a new BookMarkUI load the empty bookmark file.
+    nvim.command('python3 ranger._bookmarkUI = None')
+
+    nvim.input('ma')
+    nvim.input('lma')
+    path = os.path.join(test_local_dir, 'dir')
+    with open(bm) as f:
+        assert f.read() == f'a:{path}\n'
+    set_buf = nvim.eval(
+        "py3eval('list(ranger._bookmarkUI.bufs[\"set\"])')")
+    assert set_buf == [f'a:{path}'], set_buf
+
+
 def test_help():
     nvim.input('?')
     nvim.command('quit')
@@ -497,6 +699,11 @@ def test_NETRTogglePreview():
     pass
 
 
+def write_file(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
 def cLine_ends_with(s):
     return nvim.current.line[:-4].endswith(s)
 
@@ -509,8 +716,8 @@ def test_size_display():
 
     width = nvim.current.window.width
 
-    Shell.run('echo {} > {}'.format('a' * 1035, 'a' * width + '.pdf'))
-    Shell.run('echo {} > {}'.format('b' * 1024, 'b' * width))
+    write_file('a' * width + '.pdf', 'a' * 1035 + '\n')
+    write_file('b' * width, 'b' * 1024 + '\n')
 
     nvim.command('edit .')
     nvim.input('Gk')
@@ -534,8 +741,8 @@ def test_size_wide_char_display():
 
     width = nvim.current.window.width
 
-    Shell.run('echo {} > {}'.format('a' * 1035, '測' * width + '.pdf'))
-    Shell.run('echo {} > {}'.format('b' * 1024, '試' * width))
+    write_file('測' * width + '.pdf', 'a' * 1035 + '\n')
+    write_file('試' * width, 'b' * 1024 + '\n')
 
     nvim.command('edit .')
     nvim.input('Gk')
@@ -556,53 +763,60 @@ def test_sort():
     # extension: [a, a.a, a.b]
     # size: [a.b, a.a, a]
     # mtime: [a, a.b, a.a]
-    Shell.run('echo {} > dir/{}'.format('a' * 3, 'a'))
-    Shell.run('echo {} > dir/{}'.format('a' * 2, 'a.a'))
-    Shell.run('echo {} > dir/{}'.format('a' * 1, 'a.b'))
+    for name, content in [('a', 'aaa'), ('a.a', 'aa'), ('a.b', 'a')]:
+        write_file(f'dir/{name}', content + '\n')
+    # Sorting by mtime actually uses st_ctime, which os.utime can't set
+    # explicitly. Sleep to make sure it differs from that of a.b.
     time.sleep(0.01)
-    Shell.run('touch dir/a.a')
+    os.utime('dir/a.a', None)
 
     nvim.input('zaSe')
-    assert_content('dir', ind=0, hi='dir', level=0)
-    assert_content('a', ind=3, hi='file', level=1)
-    assert_content('a.a', ind=4, hi='file', level=1)
-    assert_content('a.b', ind=5, hi='file', level=1)
-    assert_content('dir2', ind=6, hi='dir', level=0)
+    snapshot = get_buf_snapshot()
+    assert_content('dir', ind=0, hi='dir', level=0, snapshot=snapshot)
+    assert_content('a', ind=3, hi='file', level=1, snapshot=snapshot)
+    assert_content('a.a', ind=4, hi='file', level=1, snapshot=snapshot)
+    assert_content('a.b', ind=5, hi='file', level=1, snapshot=snapshot)
+    assert_content('dir2', ind=6, hi='dir', level=0, snapshot=snapshot)
 
     nvim.input('SE')
-    assert_content('dir2', ind=0, hi='dir', level=0)
-    assert_content('dir', ind=1, hi='dir', level=0)
-    assert_content('a.b', ind=2, hi='file', level=1)
-    assert_content('a.a', ind=3, hi='file', level=1)
-    assert_content('a', ind=4, hi='file', level=1)
+    snapshot = get_buf_snapshot()
+    assert_content('dir2', ind=0, hi='dir', level=0, snapshot=snapshot)
+    assert_content('dir', ind=1, hi='dir', level=0, snapshot=snapshot)
+    assert_content('a.b', ind=2, hi='file', level=1, snapshot=snapshot)
+    assert_content('a.a', ind=3, hi='file', level=1, snapshot=snapshot)
+    assert_content('a', ind=4, hi='file', level=1, snapshot=snapshot)
 
     nvim.input('Ss')
-    assert_content('dir2', ind=0, hi='dir', level=0)
-    assert_content('dir', ind=1, hi='dir', level=0)
-    assert_content('a.b', ind=4, hi='file', level=1)
-    assert_content('a.a', ind=5, hi='file', level=1)
-    assert_content('a', ind=6, hi='file', level=1)
+    snapshot = get_buf_snapshot()
+    assert_content('dir2', ind=0, hi='dir', level=0, snapshot=snapshot)
+    assert_content('dir', ind=1, hi='dir', level=0, snapshot=snapshot)
+    assert_content('a.b', ind=4, hi='file', level=1, snapshot=snapshot)
+    assert_content('a.a', ind=5, hi='file', level=1, snapshot=snapshot)
+    assert_content('a', ind=6, hi='file', level=1, snapshot=snapshot)
 
     nvim.input('SS')
-    assert_content('dir', ind=0, hi='dir', level=0)
-    assert_content('a', ind=1, hi='file', level=1)
-    assert_content('a.a', ind=2, hi='file', level=1)
-    assert_content('a.b', ind=3, hi='file', level=1)
-    assert_content('dir2', ind=6, hi='dir', level=0)
+    snapshot = get_buf_snapshot()
+    assert_content('dir', ind=0, hi='dir', level=0, snapshot=snapshot)
+    assert_content('a', ind=1, hi='file', level=1, snapshot=snapshot)
+    assert_content('a.a', ind=2, hi='file', level=1, snapshot=snapshot)
+    assert_content('a.b', ind=3, hi='file', level=1, snapshot=snapshot)
+    assert_content('dir2', ind=6, hi='dir', level=0, snapshot=snapshot)
 
     nvim.input('Sm')
-    assert_content('dir2', ind=0, hi='dir', level=0)
-    assert_content('dir', ind=1, hi='dir', level=0)
-    assert_content('a', ind=4, hi='file', level=1)
-    assert_content('a.b', ind=5, hi='file', level=1)
-    assert_content('a.a', ind=6, hi='file', level=1)
+    snapshot = get_buf_snapshot()
+    assert_content('dir2', ind=0, hi='dir', level=0, snapshot=snapshot)
+    assert_content('dir', ind=1, hi='dir', level=0, snapshot=snapshot)
+    assert_content('a', ind=4, hi='file', level=1, snapshot=snapshot)
+    assert_content('a.b', ind=5, hi='file', level=1, snapshot=snapshot)
+    assert_content('a.a', ind=6, hi='file', level=1, snapshot=snapshot)
 
     nvim.input('SM')
-    assert_content('dir', ind=0, hi='dir', level=0)
-    assert_content('a.a', ind=1, hi='file', level=1)
-    assert_content('a.b', ind=2, hi='file', level=1)
-    assert_content('a', ind=3, hi='file', level=1)
-    assert_content('dir2', ind=6, hi='dir', level=0)
+    snapshot = get_buf_snapshot()
+    assert_content('dir', ind=0, hi='dir', level=0, snapshot=snapshot)
+    assert_content('a.a', ind=1, hi='file', level=1, snapshot=snapshot)
+    assert_content('a.b', ind=2, hi='file', level=1, snapshot=snapshot)
+    assert_content('a', ind=3, hi='file', level=1, snapshot=snapshot)
+    assert_content('dir2', ind=6, hi='dir', level=0, snapshot=snapshot)
     nvim.input('Sd')
 
 
@@ -636,7 +850,7 @@ def test_NETRDelete_remote():
 
 def test_NETRPaste_by_cut_remote2local():
     nvim.input('zajvjjvd')
-    nvim.command('vsplit {}'.format(test_local_dir))
+    nvim.command(_VSPLIT_LOCAL)
     nvim.input('jlp')
     wait_for_fs_free()
     assert_content('subdir', ind=0, hi='dir')
@@ -649,7 +863,7 @@ def test_NETRPaste_by_cut_remote2local():
 
 
 def test_NETRPaste_by_cut_local2remote():
-    nvim.command('vsplit {}'.format(test_local_dir))
+    nvim.command(_VSPLIT_LOCAL)
     ensure_buf_no_expand()
     nvim.input('zajvjjvd')
     nvim.command('wincmd w')
@@ -664,8 +878,7 @@ def test_NETRPaste_by_cut_local2remote():
 
 
 def test_NETRPaste_by_cut_remote2remote():
-    nvim.input('zajvjjvd')
-    nvim.input('Glp')
+    nvim.input('zajvjjvdGlp')
     wait_for_fs_free()
     assert_content('subdir', ind=0, hi='dir')
     assert_content('a', ind=1, hi='file')
@@ -679,7 +892,7 @@ def test_NETRPaste_by_cut_remote2remote():
 
 def test_NETRPaste_by_copy_remote2local():
     nvim.input('zajvjjvy')
-    nvim.command('vsplit {}'.format(test_local_dir))
+    nvim.command(_VSPLIT_LOCAL)
     ensure_buf_no_expand()
     nvim.input('jlp')
     wait_for_fs_free()
@@ -693,7 +906,7 @@ def test_NETRPaste_by_copy_remote2local():
 
 
 def test_NETRPaste_by_copy_local2remote():
-    nvim.command('vsplit {}'.format(test_local_dir))
+    nvim.command(_VSPLIT_LOCAL)
     ensure_buf_no_expand()
     nvim.input('zajvjjvy')
     nvim.command('wincmd w')
@@ -708,8 +921,7 @@ def test_NETRPaste_by_copy_local2remote():
 
 
 def test_NETRPaste_by_copy_remote2remote():
-    nvim.input('zajvjjvy')
-    nvim.input('Glp')
+    nvim.input('zajvjjvyGlp')
     wait_for_fs_free()
     assert_content('subdir', ind=0, hi='dir')
     assert_content('a', ind=1, hi='file')
@@ -798,6 +1010,164 @@ def test_api_rm_remote():
     assert_fs_remote('dir', ['subdir2'])
 
 
+def do_test_navigation():
+    do_test_inplace(test_on_cursormoved)
+    do_test_inplace(test_NETROpen)
+    do_test_inplace(test_NETRParent)
+    do_test_inplace(test_NETRGoPrevSibling)
+    do_test_inplace(test_on_bufenter_cursor_stay_the_same_pos)
+    do_test_inplace(test_on_bufenter_content_stay_the_same)
+    do_test_inplace(test_on_bufenter_fs_change)
+    do_test_inplace(test_NETRToggleExpand)
+    do_test_inplace(test_NETRToggleExpandRec)
+    do_test_inplace(test_NETRVimCD)
+    close_test_tab()
+
+
+def do_test_edit():
+    do_test(test_NETREdit)
+    do_test(test_NETRNew)
+
+
+def do_test_delete():
+    do_test_inplace(test_NETRDelete)
+    do_test_inplace(test_NETRDeleteSingle)
+    do_test_inplace(test_NETRForceDelete)
+    do_test_inplace(test_NETRForceDeleteSingle)
+    close_test_tab()
+
+    # # Can't pass on travis, don't know why
+    # do_test(test_delete_fail_if_fs_lock)
+    # do_test(test_delete_single_fail_if_fs_lock)
+    # do_test(test_force_delete_fail_if_fs_lock)
+    # do_test(test_force_delete_single_fail_if_fs_lock)
+
+
+def do_test_pickCopyCutPaste():
+    do_test_inplace(test_NETRTogglePick)
+    do_test_inplace(test_NETRTogglePickVisual)
+    do_test_inplace(test_NETRCut)
+    do_test_inplace(test_NETRCopy)
+    do_test_inplace(test_NETRCutSingle)
+    do_test_inplace(test_NETRCopySingle)
+
+    # reset pick,cut,copy sets because previous tests do not paste to
+    # reset them
+    nvim.command('python3 ranger._reset_pick_cut_copy()')
+    do_test_inplace(test_NETRPaste_by_cut)
+    do_test_inplace(test_NETRPaste_by_copy)
+    do_test_inplace(test_NETRPaste_sided_by_side)
+    close_test_tab()
+
+
+def do_test_display():
+    do_test(test_NETRTogglePreview)
+    do_test(test_NETRToggleShowHidden)
+    do_test(test_size_display)
+    do_test(test_size_wide_char_display)
+    do_test(test_sort)
+    do_test(test_opt_Autochdir)
+    do_test(test_rifle)
+
+
+def do_test_api():
+    do_test(test_api_cur_node_name)
+    do_test(test_api_cur_node_path)
+
+    do_test(test_api_cp)
+    do_test(test_api_mv)
+    do_test(test_api_rm)
+
+
+def do_test_UI():
+    do_test(test_bookmark)
+    do_test(test_bookmark_set_twice_from_empty)
+    do_test(test_help)
+
+
+def do_test_api_remote():
+    do_test(fn_remote=test_api_cp_remote)
+    do_test(fn_remote=test_api_mv_remote)
+    do_test(fn_remote=test_api_rm_remote)
+
+
+def do_test_delete_remote():
+    do_test(fn_remote=test_NETRDelete_remote)
+
+
+def do_test_pickCopyCutPaste_remote():
+    do_test(fn_remote=test_NETRPaste_by_cut_local2remote)
+    do_test(fn_remote=test_NETRPaste_by_cut_remote2local)
+    do_test(fn_remote=test_NETRPaste_by_cut_remote2remote)
+
+    do_test(fn_remote=test_NETRPaste_by_copy_local2remote)
+    do_test(fn_remote=test_NETRPaste_by_copy_remote2local)
+    do_test(fn_remote=test_NETRPaste_by_copy_remote2remote)
+
+
+# Test groups that only touch test_dir. They can run in parallel, each in its
+# own process with its own neovim and test_dir.
+local_test_groups = [
+    do_test_api,
+    do_test_navigation,
+    do_test_edit,
+    do_test_delete,
+    do_test_pickCopyCutPaste,
+    do_test_display,
+]
+
+# Test groups that share states across processes (the bookmark file, the
+# rclone remote and its cache). They always run in the main process.
+shared_test_groups = [
+    do_test_UI,
+    do_test_api_remote,
+    do_test_delete_remote,
+    do_test_pickCopyCutPaste_remote,
+]
+
+test_groups = {
+    fn.__name__: fn
+    for fn in local_test_groups + shared_test_groups
+}
+
+
+def init_shared_state():
+    """
+    Let a throwaway headless neovim initialize netranger once so that the
+    states shared by all processes (the netranger root directory, the rifle
+    file copied into it and the remote cache directory) already exist
+    before the child processes start and race on creating them.
+    """
+    init_nvim = attach('child',
+                       argv=[
+                           'nvim', '-u', './test_init.vim', '--embed',
+                           '--headless'
+                       ])
+    init_nvim.command('call NetrangerInit()')
+    init_nvim.close()
+
+
+def run_groups_in_parallel(groups, jobs):
+    """
+    Run each group in a child `test.py --group` process with its own
+    NETRANGER_TEST_DIR. Return True if all of them succeed.
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    init_shared_state()
+
+    def run_group(i, group):
+        env = dict(os.environ, NETRANGER_TEST_DIR=f'{test_dir}_{i}')
+        return subprocess.run(
+            [sys.executable, __file__, '--group', group.__name__],
+            cwd=cwd,
+            env=env).returncode
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        returncodes = list(
+            executor.map(run_group, range(len(groups)), groups))
+    return all(r == 0 for r in returncodes)
+
+
 def parse_arg(argv):
     parser = argparse.ArgumentParser(description='')
     parser.add_argument(
@@ -810,17 +1180,38 @@ def parse_arg(argv):
         default=None,
         help='NVIM_LISTEN_ADDRESS for an open neovim. If set to none, open a \
         headless neovim instead.')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of processes for running the local test groups in \
+        parallel. Each process starts its own headless neovim.')
+    parser.add_argument('--group',
+                        action='append',
+                        choices=list(test_groups),
+                        help='Only run the given test group(s).')
     return parser.parse_args(argv[1:])
 
 
 if __name__ == '__main__':
     args = parse_arg(sys.argv)
+    build_test_template()
     if args.manual:
         nvim = attach(
             'child',
             argv=['nvim', '-u', './test_init.vim', '--embed', '--headless'])
         do_test()
     else:
+        if args.group:
+            groups = [test_groups[name] for name in args.group]
+        elif args.jobs > 1:
+            if not run_groups_in_parallel(local_test_groups, args.jobs):
+                sys.exit(1)
+            groups = shared_test_groups
+        else:
+            groups = local_test_groups + shared_test_groups
+
         if args.listen_address:
             nvim = attach('socket', path=args.listen_address)
         else:
@@ -830,91 +1221,8 @@ if __name__ == '__main__':
                               '--headless'
                           ])
 
-        def do_test_navigation():
-            do_test(test_on_cursormoved)
-            do_test(test_NETROpen)
-            do_test(test_NETRParent)
-            do_test(test_NETRGoPrevSibling)
-            do_test(test_on_bufenter_cursor_stay_the_same_pos)
-            do_test(test_on_bufenter_content_stay_the_same)
-            do_test(test_on_bufenter_fs_change)
-            do_test(test_NETRToggleExpand)
-            do_test(test_NETRToggleExpandRec)
-            do_test(test_NETRVimCD)
-
-        def do_test_delete():
-            do_test(test_NETRDelete)
-            do_test(test_NETRDeleteSingle)
-            do_test(test_NETRForceDelete)
-            do_test(test_NETRForceDeleteSingle)
-
-            # # Can't pass on travis, don't know why
-            # do_test(test_delete_fail_if_fs_lock)
-            # do_test(test_delete_single_fail_if_fs_lock)
-            # do_test(test_force_delete_fail_if_fs_lock)
-            # do_test(test_force_delete_single_fail_if_fs_lock)
-
-        def do_test_pickCopyCutPaste():
-            do_test(test_NETRTogglePick)
-            do_test(test_NETRTogglePickVisual)
-            do_test(test_NETRCut)
-            do_test(test_NETRCopy)
-            do_test(test_NETRCutSingle)
-            do_test(test_NETRCopySingle)
-
-            # reset pick,cut,copy sets because previous tests do not paste to
-            # reset them
-            nvim.command('python3 ranger._reset_pick_cut_copy()')
-            do_test(test_NETRPaste_by_cut)
-            do_test(test_NETRPaste_by_copy)
-            do_test(test_NETRPaste_sided_by_side)
-
-        def do_test_delete_remote():
-            do_test(fn_remote=test_NETRDelete_remote)
-
-        def do_test_pickCopyCutPaste_remote():
-            do_test(fn_remote=test_NETRPaste_by_cut_local2remote)
-            do_test(fn_remote=test_NETRPaste_by_cut_remote2local)
-            do_test(fn_remote=test_NETRPaste_by_cut_remote2remote)
-
-            do_test(fn_remote=test_NETRPaste_by_copy_local2remote)
-            do_test(fn_remote=test_NETRPaste_by_copy_remote2local)
-            do_test(fn_remote=test_NETRPaste_by_copy_remote2remote)
-
-        def do_test_UI():
-            do_test(test_bookmark)
-            do_test(test_help)
-
-        def do_test_api():
-            do_test(test_api_cur_node_name)
-            do_test(test_api_cur_node_path)
-
-            do_test(test_api_cp)
-            do_test(test_api_mv)
-            do_test(test_api_rm)
-
-            do_test(fn_remote=test_api_cp_remote)
-            do_test(fn_remote=test_api_mv_remote)
-            do_test(fn_remote=test_api_rm_remote)
-
-        do_test_api()
-        do_test(test_NETRTogglePreview)
-        do_test_navigation()
-        do_test(test_NETREdit)
-        do_test(test_NETRNew)
-        do_test_delete()
-        do_test_pickCopyCutPaste()
-        do_test(test_NETRToggleShowHidden)
-        do_test(test_size_display)
-        do_test(test_size_wide_char_display)
-        do_test(test_sort)
-        do_test(test_opt_Autochdir)
-        do_test_UI()
-
-        do_test_delete_remote()
-        do_test_pickCopyCutPaste_remote()
-
-        do_test(test_rifle)
+        for group in groups:
+            group()
 
         # do_test(fn_remote=test_edit_remote)
         # # TODO
@@ -929,8 +1237,9 @@ if __name__ == '__main__':
 
         try:
             # Force down rclone server down
-            subprocess.check_output(
-                f'rclone rc core/quit --rc-addr=localhost:{rclone_rcd_port}',
-                shell=True)
+            subprocess.run(['rclone', 'rc', 'core/quit',
+                            f'--rc-addr=localhost:{rclone_rcd_port}'],
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
         except Exception:
             pass
@@ -24,11 +24,15 @@ class Shell():
 
     @classmethod
     def touch(cls, name):
-        Shell.run('touch "{}"'.format(name))
+        with open(name, 'a'):
+            os.utime(name, None)
 
     @classmethod
     def rm(cls, name):
-        Shell.run('rm -r ' + name)
+        if os.path.isdir(name) and not os.path.islink(name):
+            shutil.rmtree(name)
+        else:
+            os.remove(name)
 
     @classmethod
     def shellrc(cls):